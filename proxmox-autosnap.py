@@ -2,12 +2,22 @@
 import os
 import re
 import json
+import fcntl
+import heapq
+import shlex
 import socket
 import argparse
 import functools
+import threading
 import subprocess
+import concurrent.futures
 from datetime import datetime, timedelta
 
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
 MUTE = False
 DRY_RUN = False
 USE_SUDO = False
@@ -19,60 +29,162 @@ INCLUDE_VM_STATE = False
 # Name of the currently running node
 NODE_NAME = socket.gethostname().split('.')[0]
 
+# Cluster-wide list of VM IDs maintained by pmxcfs
+VMLIST_PATH = '/etc/pve/.vmlist'
+
+# pveversion result kept across runs, stale once dpkg has installed anything newer
+VERSION_CACHE_PATH = '/run/proxmox-autosnap.version'
+DPKG_STATUS_PATH = '/var/lib/dpkg/status'
+
+# Autosnapshot names per label, as listed by qm/pct listsnapshot
+SNAPSHOT_RE = {label: re.compile(r'auto{0}([_0-9T]+$)'.format(label))
+               for label in ('minute', 'hourly', 'daily', 'weekly', 'monthly')}
+
+# VM config keys of the volumes sent by zfs_send
+MOUNTPOINT_RE = re.compile('mp[0-9]+')
+DISK_RE = re.compile('(ide|sata|scsi|virtio)[0-9]+')
+EFIDISK_RE = re.compile('(efidisk|tpmstate)[0-9]+')
+
+# Held for the whole run, released by the kernel when the process exits. Shared by every user
+# running the script, so root cron and --sudo runs exclude each other.
+LOCK_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'running.lock')
+
+# Serializes output lines written from worker threads
+PRINT_LOCK = threading.Lock()
+
 
 def running(func):
     @functools.wraps(func)
-    def create_pid(*args, **kwargs):
-        pid = str(os.getpid())
-        location = os.path.dirname(os.path.realpath(__file__))
-        location_pid = os.path.join(location, 'running.pid')
-        if os.path.isfile(location_pid):
-            with open(location_pid) as f:
-                print('Script already running under PID {0}, skipping execution.'.format(f.read()))
-            raise SystemExit(1)
+    def acquire_lock(*args, **kwargs):
+        writable = True
+        try:
+            try:
+                fd = os.open(LOCK_PATH, os.O_RDWR | os.O_CREAT, 0o644)
+            except PermissionError:
+                # Created by another user, flock works just as well on a read-only descriptor
+                fd = os.open(LOCK_PATH, os.O_RDONLY)
+                writable = False
+        except OSError as e:
+            raise SystemExit('Unable to open lock file {0}: {1}'.format(LOCK_PATH, e.strerror))
+
         try:
-            with open(location_pid, 'w') as f:
-                f.write(pid)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                pid = os.pread(fd, 32, 0).decode() or 'unknown'
+                print('Script already running under PID {0}, skipping execution.'.format(pid))
+                raise SystemExit(1)
+
+            if writable:
+                os.ftruncate(fd, 0)
+                os.write(fd, str(os.getpid()).encode())
             return func(*args, **kwargs)
         finally:
-            os.unlink(location_pid)
+            os.close(fd)
 
-    return create_pid
+    return acquire_lock
 
 
-def run_command(command: list, force_no_sudo: bool = False) -> dict:
-    if USE_SUDO and not force_no_sudo:
-        command.insert(0, 'sudo')
+def output(message: str) -> None:
+    with PRINT_LOCK:
+        print(message)
+
+
+def make_log(mute: bool):
+    # Informational messages are only formatted when they are actually printed
+    if mute:
+        return lambda message, *args: None
 
-    run = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    out, err = run.communicate()
+    return lambda message, *args: output(message % args)
+
+
+log = make_log(MUTE)
+
+
+def get_full_command(command: list, force_no_sudo: bool = False) -> list:
+    return ['sudo', *command] if USE_SUDO and not force_no_sudo else command
+
+
+def run_command_bytes(command: list, force_no_sudo: bool = False) -> dict:
+    run = subprocess.run(get_full_command(command, force_no_sudo=force_no_sudo), capture_output=True)
     if run.returncode == 0:
-        return {'status': True, 'message': out.decode('utf-8', 'replace').rstrip()}
+        return {'status': True, 'message': run.stdout}
     else:
-        return {'status': False, 'message': err.decode('utf-8', 'replace').rstrip()}
+        return {'status': False, 'message': run.stderr.decode('utf-8', 'replace').rstrip()}
+
+
+def run_command(command: list, force_no_sudo: bool = False) -> dict:
+    run = run_command_bytes(command, force_no_sudo=force_no_sudo)
+    if run['status']:
+        return {'status': True, 'message': run['message'].decode('utf-8', 'replace').rstrip()}
+    else:
+        return run
+
 
+def run_commands(commands: list, require_first: bool = False) -> list:
+    if len(commands) == 1:
+        return [run_command(commands[0])]
 
+    # Run all commands from one shell, reporting one OK/FAIL line per command
+    script = []
+    for num, command in enumerate(commands):
+        script.append('if out=$({0} 2>&1); then echo OK; else echo "FAIL $(printf %s "$out" | {1})"; {2}fi'
+                      .format(shlex.join(get_full_command(command)), "tr -s '\\n\\r\\v\\f' ' '",
+                              'exit; ' if require_first and num == 0 else ''))
+
+    run = run_command(['sh', '-c', '\n'.join(script)], force_no_sudo=True)
+    if not run['status']:
+        return [run] * len(commands)
+
+    results = []
+    for line in run['message'].split('\n'):
+        status, _, message = line.partition(' ')
+        if status not in ('OK', 'FAIL'):
+            results = None
+            break
+        results.append({'status': status == 'OK', 'message': message.rstrip()})
+
+    # With require_first, a failed first command is the only line
+    expected = len(commands)
+    if require_first and results and not results[0]['status']:
+        expected = 1
+
+    if results is None or len(results) != expected:
+        failure = {'status': False, 'message': 'Unexpected output from batched commands: {0}'.format(run['message'])}
+        return [failure] * len(commands)
+
+    return results
+
+
+@functools.lru_cache(maxsize=None)
 def get_proxmox_version() -> float:
+    try:
+        if os.stat(VERSION_CACHE_PATH).st_mtime >= os.stat(DPKG_STATUS_PATH).st_mtime:
+            with open(VERSION_CACHE_PATH) as f:
+                return float(f.read())
+    except (OSError, ValueError):
+        pass
+
     result = run_command(['pveversion'], force_no_sudo=True)
     if not result['status']:
         raise SystemExit(result['message'])
 
     version_string = result['message'].split('/')[1].split('-')[0]
     try:
-        return float(version_string)
+        version = float(version_string)
     except ValueError:
-        return float(".".join(version_string.split(".")[:2]))
-
+        version = float(".".join(version_string.split(".")[:2]))
 
-def vm_is_stopped(vmid: str, virtualization: str) -> bool:
-    run = run_command([virtualization, 'status', vmid])
-    if run['status']:
-        if 'stopped' in run['message'].lower():
-            return True
+    try:
+        with open(VERSION_CACHE_PATH, 'w') as f:
+            f.write(str(version))
+    except OSError:
+        pass
 
-    return False
+    return version
 
 
+@functools.lru_cache(maxsize=None)
 def get_pve_config(vmid: str, virtualization: str) -> dict:
     run = run_command([virtualization, 'config', vmid])
     if not run['status']:
@@ -81,15 +193,16 @@ def get_pve_config(vmid: str, virtualization: str) -> dict:
     cfg = {}
 
     for line in run['message'].splitlines():
-        if ':' in line:
-            (k, v) = line.split(': ')
+        k, sep, v = line.partition(': ')
+        if sep:
             cfg[k.strip()] = v.strip()
 
     return cfg
 
 
+@functools.lru_cache(maxsize=None)
 def get_zfs_volume(proxmox_fs: str, virtualization: str) -> str:
-    run = run_command(['pvesm', 'path', proxmox_fs.split(',')[0]])
+    run = run_command(['pvesm', 'path', proxmox_fs.partition(',')[0]])
     if not run['status']:
         raise SystemExit(run['message'])
 
@@ -102,13 +215,29 @@ def get_zfs_volume(proxmox_fs: str, virtualization: str) -> str:
         return zfsvol
 
 
-def get_vmids(exclude: list) -> dict:
-    run = run_command(['cat', '/etc/pve/.vmlist'])
-    if not run['status']:
-        raise SystemExit(run['message'])
+def read_vmlist() -> dict:
+    try:
+        with open(VMLIST_PATH, 'rb') as f:
+            content = f.read()
+    except PermissionError:
+        if not USE_SUDO:
+            raise
+
+        # The file is readable only by root and www-data, go through the sudo rule instead
+        run = run_command(['cat', VMLIST_PATH])
+        if not run['status']:
+            raise PermissionError(run['message'])
 
+        return json_loads(run['message'])
+
+    return json_loads(content)
+
+
+def get_vmids(exclude: list) -> dict:
     try:
-        json_data = json.loads(run['message'])
+        json_data = read_vmlist()
+    except OSError as e:
+        raise SystemExit(str(e))
     except json.JSONDecodeError as e:
         raise SystemExit('Error decoding JSON: {0}'.format(e))
 
@@ -124,28 +253,32 @@ def get_vmids(exclude: list) -> dict:
     return result
 
 
-def get_vmids_by_tags(tags: list, exclude_tags: list) -> dict:
-    run = run_command(['pvesh', 'get', '/cluster/resources', '--type', 'vm', '--output-format', 'json'])
+def get_vm_resources() -> dict:
+    run = run_command_bytes(['pvesh', 'get', '/cluster/resources', '--type', 'vm', '--output-format', 'json'])
     if not run['status']:
         raise SystemExit(run['message'])
 
     try:
-        json_data = json.loads(run['message'])
+        json_data = json_loads(run['message'])
     except json.JSONDecodeError as e:
         raise SystemExit('Error decoding JSON: {0}'.format(e))
 
-    result = {'include': [], 'exclude': []}
-    for vm in json_data:
-        vmid = str(vm['vmid'])
-        vm_tags = vm.get('tags', '').split(';')
+    # Status and tags of local VMs, fetched in one call for the whole node
+    return {str(vm['vmid']): vm for vm in json_data if vm['node'] == NODE_NAME}
+
 
-        if vm['node'] != NODE_NAME:
-            continue
+def get_vmids_by_tags(resources: dict, tags: list, exclude_tags: list) -> dict:
+    tag_set = frozenset(tags or ())
+    exclude_tag_set = frozenset(exclude_tags or ())
 
-        if tags and any(tag in vm_tags for tag in tags):
+    result = {'include': [], 'exclude': []}
+    for vmid, vm in resources.items():
+        vm_tags = frozenset(vm.get('tags', '').split(';'))
+
+        if tag_set & vm_tags:
             result['include'].append(vmid)
 
-        if exclude_tags and any(tag in vm_tags for tag in exclude_tags):
+        if exclude_tag_set & vm_tags:
             result['exclude'].append(vmid)
 
     return result
@@ -153,6 +286,7 @@ def get_vmids_by_tags(tags: list, exclude_tags: list) -> dict:
 
 def get_filtered_vmids(vmids: list, exclude: list, tags: list, exclude_tags: list) -> dict:
     all_vmid = get_vmids(exclude=exclude)
+    resources = get_vm_resources() if ONLY_ON_RUNNING or tags or exclude_tags else {}
     picked_vmid = {}
 
     if vmids and 'all' in vmids:
@@ -169,7 +303,7 @@ def get_filtered_vmids(vmids: list, exclude: list, tags: list, exclude_tags: lis
         if not proxmox_version >= 7.3:
             raise SystemExit('Proxmox version {0} does not support tags.'.format(proxmox_version))
 
-        vmids_by_tags = get_vmids_by_tags(tags=tags, exclude_tags=exclude_tags)
+        vmids_by_tags = get_vmids_by_tags(resources=resources, tags=tags, exclude_tags=exclude_tags)
 
         if tags:
             for vmid_by_tags in vmids_by_tags['include']:
@@ -182,93 +316,137 @@ def get_filtered_vmids(vmids: list, exclude: list, tags: list, exclude_tags: lis
             for vmid_by_tags in vmids_by_tags['exclude']:
                 picked_vmid.pop(vmid_by_tags, None)
 
-    return picked_vmid
+    if ONLY_ON_RUNNING:
+        for vmid in list(picked_vmid):
+            if resources.get(vmid, {}).get('status') == 'stopped':
+                log('VM %s - status is stopped, skipping...', vmid)
+                picked_vmid.pop(vmid)
 
+    return picked_vmid
 
-def create_snapshot(vmid: str, virtualization: str, label: str = 'daily') -> None:
-    if ONLY_ON_RUNNING and vm_is_stopped(vmid, virtualization):
-        print('VM {0} - status is stopped, skipping...'.format(vmid)) if not MUTE else None
-        return
 
-    labels = {'minute': 'autominute', 'hourly': 'autohourly', 'daily': 'autodaily', 'weekly': 'autoweekly',
-              'monthly': 'automonthly'}
+def get_snapshot_suffix() -> str:
     suffix_datetime = datetime.now() + timedelta(seconds=1)
     if DATE_ISO_FORMAT:
-        suffix = '_' + suffix_datetime.isoformat(timespec='seconds').replace('-', '_').replace(':', '_')
+        return '_' + suffix_datetime.isoformat(timespec='seconds').replace('-', '_').replace(':', '_')
     elif DATE_TRUENAS_FORMAT:
-        suffix = suffix_datetime.strftime('%Y%m%d%H%M%S')
+        return suffix_datetime.strftime('%Y%m%d%H%M%S')
     else:
-        suffix = suffix_datetime.strftime('%y%m%d%H%M%S')
-    snapshot_name = labels[label] + suffix
+        return suffix_datetime.strftime('%y%m%d%H%M%S')
+
+
+def get_snapshot_params(vmid: str, virtualization: str, snapshot_name: str) -> list:
     params = [virtualization, 'snapshot', vmid, snapshot_name, '--description', 'autosnap']
 
     if virtualization == 'qm' and INCLUDE_VM_STATE:
         params.append('--vmstate')
 
+    return params
+
+
+def create_snapshot(vmid: str, virtualization: str, suffix: str, label: str = 'daily') -> None:
+    snapshot_name = 'auto' + label + suffix
+    params = get_snapshot_params(vmid, virtualization, snapshot_name)
+
     if DRY_RUN:
-        params.insert(0, 'sudo') if USE_SUDO else None
-        print(' '.join(params))
+        output(' '.join(get_full_command(params)))
     else:
         run = run_command(params)
         if run['status']:
-            print('VM {0} - Creating snapshot {1}'.format(vmid, snapshot_name)) if not MUTE else None
+            log('VM %s - Creating snapshot %s', vmid, snapshot_name)
         else:
-            print('VM {0} - {1}'.format(vmid, run['message']))
-
+            output('VM {0} - {1}'.format(vmid, run['message']))
 
-def remove_snapshot(vmid: str, virtualization: str, label: str = 'daily', keep: int = 30) -> None:
-    if ONLY_ON_RUNNING and vm_is_stopped(vmid, virtualization):
-        print('VM {0} - status is stopped, skipping...'.format(vmid)) if not MUTE else None
-        return
 
+def list_snapshots(vmid: str, virtualization: str, label: str = 'daily') -> list:
     listsnapshot = []
     snapshots = run_command([virtualization, 'listsnapshot', vmid])
     if not snapshots['status']:
         raise SystemExit(snapshots['message'])
 
     for snapshot in snapshots['message'].splitlines():
-        snapshot = re.search(r'auto{0}([_0-9T]+$)'.format(label), snapshot.replace('`->', '').split()[0])
+        snapshot = SNAPSHOT_RE[label].search(snapshot.replace('`->', '').split()[0])
         if snapshot is not None:
             listsnapshot.append(snapshot.group(0))
 
-    if listsnapshot and len(listsnapshot) > keep:
-        old_snapshots = [snap for num, snap in enumerate(sorted(listsnapshot, reverse=True), 1) if num > keep]
-        if old_snapshots:
-            for old_snapshot in old_snapshots:
-                params = [virtualization, 'delsnapshot', vmid, old_snapshot]
-                if DRY_RUN:
-                    params.insert(0, 'sudo') if USE_SUDO else None
-                    print(' '.join(params))
-                else:
-                    run = run_command(params)
-                    if run['status']:
-                        print('VM {0} - Removing snapshot {1}'.format(vmid, old_snapshot)) if not MUTE else None
-                    else:
-                        print('VM {0} - {1}'.format(vmid, run['message']))
+    return listsnapshot
+
+
+def remove_snapshot(vmid: str, virtualization: str, label: str = 'daily', keep: int = 30) -> None:
+    listsnapshot = list_snapshots(vmid, virtualization, label)
+
+    # Everything except the newest ones to keep, oldest first
+    old_snapshots = heapq.nsmallest(max(0, len(listsnapshot) - keep), listsnapshot)
+    if DRY_RUN:
+        for old_snapshot in old_snapshots:
+            output(' '.join(get_full_command([virtualization, 'delsnapshot', vmid, old_snapshot])))
+    elif old_snapshots:
+        runs = run_commands([[virtualization, 'delsnapshot', vmid, old_snapshot] for old_snapshot in old_snapshots])
+        for old_snapshot, run in zip(old_snapshots, runs):
+            if run['status']:
+                log('VM %s - Removing snapshot %s', vmid, old_snapshot)
+            else:
+                output('VM {0} - {1}'.format(vmid, run['message']))
+
+
+def rotate_snapshot(vmid: str, virtualization: str, suffix: str, label: str = 'daily', keep: int = 30) -> None:
+    if DRY_RUN:
+        create_snapshot(vmid=vmid, virtualization=virtualization, suffix=suffix, label=label)
+        remove_snapshot(vmid=vmid, virtualization=virtualization, label=label, keep=keep)
+        return
+
+    # The new snapshot is the newest one, so what to delete is known before it is taken
+    snapshot_name = 'auto' + label + suffix
+    listsnapshot = list_snapshots(vmid, virtualization, label) + [snapshot_name]
+    old_snapshots = heapq.nsmallest(max(0, len(listsnapshot) - keep), listsnapshot)
+
+    # Create and delete from one Python-level spawn, deleting nothing if the snapshot failed.
+    # sh still runs one qm/pct process per command.
+    commands = [get_snapshot_params(vmid, virtualization, snapshot_name)]
+    commands += [[virtualization, 'delsnapshot', vmid, old_snapshot] for old_snapshot in old_snapshots]
+    runs = run_commands(commands, require_first=True)
+
+    actions = ['Creating'] + ['Removing'] * len(old_snapshots)
+    for action, snapshot, run in zip(actions, [snapshot_name] + old_snapshots, runs):
+        if run['status']:
+            log('VM %s - %s snapshot %s', vmid, action, snapshot)
+        else:
+            output('VM {0} - {1}'.format(vmid, run['message']))
 
 
 def zfs_send(vmid: str, virtualization: str, zfs_send_to: str):
     cfg = get_pve_config(vmid, virtualization)
 
     for k, v in cfg.items():
-        proxmox_vol = v.split(',')[0]
+        proxmox_vol = v.partition(',')[0]
         if (k == 'rootfs' or
-                (re.fullmatch('mp[0-9]+', k) and ('backup=1' in v)) or
-                (re.fullmatch('(ide|sata|scsi|virtio)[0-9]+', k) and ('backup=0' not in v) and proxmox_vol != 'none') or
-                (re.fullmatch('(efidisk|tpmstate)[0-9]+', k))):
+                (MOUNTPOINT_RE.fullmatch(k) and ('backup=1' in v)) or
+                (DISK_RE.fullmatch(k) and ('backup=0' not in v) and proxmox_vol != 'none') or
+                (EFIDISK_RE.fullmatch(k))):
 
             localzfs = get_zfs_volume(proxmox_vol, virtualization)
-            remotezfs = os.path.join(zfs_send_to, proxmox_vol.split(':')[1])
+            remotezfs = os.path.join(zfs_send_to, proxmox_vol.partition(':')[2])
 
             params = ['/usr/sbin/syncoid', localzfs, remotezfs, '--identifier=autosnap', '--no-privilege-elevation']
             if DRY_RUN:
-                print(' '.join(params))
+                output(' '.join(get_full_command(params, force_no_sudo=True)))
             else:
                 run = run_command(params, force_no_sudo=True)
                 if run['status']:
-                    print('VM {0} - syncoid to {1}'.format(vmid, zfs_send_to)) if not MUTE else None
+                    log('VM %s - syncoid to %s', vmid, zfs_send_to)
                 else:
-                    print('VM {0} - syncoid FAIL: {1}'.format(vmid, run['message']))
+                    output('VM {0} - syncoid FAIL: {1}'.format(vmid, run['message']))
+
+
+def process_vmid(vmid: str, virtualization: str, suffix: str, argp: argparse.Namespace) -> None:
+    if argp.snap:
+        create_snapshot(vmid=vmid, virtualization=virtualization, suffix=suffix, label=argp.label)
+    elif argp.clean:
+        remove_snapshot(vmid=vmid, virtualization=virtualization, label=argp.label, keep=argp.keep)
+    elif argp.autosnap:
+        rotate_snapshot(vmid=vmid, virtualization=virtualization, suffix=suffix, label=argp.label, keep=argp.keep)
+    elif argp.zfs_send_to:
+        zfs_send(vmid=vmid, virtualization=virtualization, zfs_send_to=argp.zfs_send_to)
 
 
 @running
@@ -294,13 +472,18 @@ def main():
     parser.add_argument('-d', '--dryrun', action='store_true',
                         help='Do not create or delete snapshots, just print the commands.')
     parser.add_argument('--sudo', action='store_true', help='Launch commands through sudo.')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='The number of VMs to process in parallel.')
     argp = parser.parse_args()
 
     if not argp.vmid and not argp.tags and not argp.exclude_tags:
         parser.error('At least one of --vmid or --tags or --exclude-tags is required.')
 
-    global MUTE, DRY_RUN, USE_SUDO, ONLY_ON_RUNNING, INCLUDE_VM_STATE, DATE_ISO_FORMAT, DATE_TRUENAS_FORMAT
+    if argp.jobs < 1:
+        parser.error('--jobs must be at least 1.')
+
+    global MUTE, DRY_RUN, USE_SUDO, ONLY_ON_RUNNING, INCLUDE_VM_STATE, DATE_ISO_FORMAT, DATE_TRUENAS_FORMAT, log
     MUTE = argp.mute
+    log = make_log(MUTE)
     DRY_RUN = argp.dryrun
     USE_SUDO = argp.sudo
     ONLY_ON_RUNNING = argp.running
@@ -311,21 +494,35 @@ def main():
     picked_vmid = get_filtered_vmids(vmids=argp.vmid, exclude=argp.exclude, tags=argp.tags,
                                      exclude_tags=argp.exclude_tags)
 
-    if argp.snap:
-        for k, v in picked_vmid.items():
-            create_snapshot(vmid=k, virtualization=v, label=argp.label)
-    elif argp.clean:
-        for k, v in picked_vmid.items():
-            remove_snapshot(vmid=k, virtualization=v, label=argp.label, keep=argp.keep)
-    elif argp.autosnap:
-        for k, v in picked_vmid.items():
-            create_snapshot(vmid=k, virtualization=v, label=argp.label)
-            remove_snapshot(vmid=k, virtualization=v, label=argp.label, keep=argp.keep)
-    elif argp.zfs_send_to:
+    if not (argp.snap or argp.clean or argp.autosnap or argp.zfs_send_to):
+        parser.print_help()
+        return
+
+    # One timestamp for the whole run, so every VM gets the same snapshot name
+    suffix = get_snapshot_suffix()
+
+    # A failing VM does not stop the others, every error is reported and the run exits non-zero
+    failed = False
+    if argp.jobs == 1:
         for k, v in picked_vmid.items():
-            zfs_send(vmid=k, virtualization=v, zfs_send_to=argp.zfs_send_to)
+            try:
+                process_vmid(vmid=k, virtualization=v, suffix=suffix, argp=argp)
+            except SystemExit as e:
+                output('VM {0} - {1}'.format(k, e))
+                failed = True
     else:
-        parser.print_help()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=argp.jobs) as executor:
+            futures = {executor.submit(process_vmid, vmid=k, virtualization=v, suffix=suffix, argp=argp): k
+                       for k, v in picked_vmid.items()}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    future.result()
+                except SystemExit as e:
+                    output('VM {0} - {1}'.format(futures[future], e))
+                    failed = True
+
+    if failed:
+        raise SystemExit(1)
 
 
 if __name__ == '__main__':